@@ -1,72 +1,91 @@
 import yaml
-import re
+import atexit
+import functools
+import operator
+import os
+import signal
+import sys
+import threading
+import weakref
 import subprocess
 import time
 import pygit2
-from typing import List, Tuple, Optional, TypeVar
-from pkg_resources import parse_version
-from setuptools.extern.packaging.version import Version as SetuptoolsVersion
+from typing import List, Tuple, Optional, TypeVar, Deque, Iterator, ClassVar, Set
+from packaging.version import Version as PackagingVersion, InvalidVersion
 from pathlib import Path
 from pygit2 import clone_repository, Repository, GIT_FETCH_PRUNE
+from pygit2.enums import ReferenceFilter
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from yaml import CBaseLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import BaseLoader as YamlLoader, SafeDumper as YamlDumper
 
 V = TypeVar("V", bound="Version")
 
+cached_parse_version = functools.lru_cache(maxsize=4096)(PackagingVersion)
+"""Memoized version parsing, the same tags are parsed on every update"""
+
+TAG_REFERENCE_PREFIX = "refs/tags/"
+"""Prefix of the tag references"""
+
+BUILD_OUTPUT_LINES = 1000
+"""Number of last build output lines printed when build fails"""
+
+stop_event = threading.Event()
+"""Set when the updater was interrupted, new builds are not started"""
 
+
+@functools.total_ordering
 class Version(object):
     def __init__(self, version):
         self.name = version
         """Version name"""
-        self.version: SetuptoolsVersion = parse_version(version)
+        self.version: PackagingVersion = cached_parse_version(version)
         """Version object"""
 
+        self._hash = hash(self.version)
+        self._description = f"<Version({self.name}, {str(self.version)})>"
+
     @property
     def is_stable(self):
         return not self.version.is_prerelease and not self.version.is_postrelease
 
-    def __str__(self):
-        return f"<Version({self.name}, {str(self.version)})>"
-
     def __repr__(self):
-        return f"<Version({self.name}, {str(self.version)})>"
+        return self._description
 
     def __hash__(self):
-        return hash(self.version)
+        return self._hash
 
     def __lt__(self, other: V):
         return self.version.__lt__(other.version)
 
-    def __le__(self, other: V):
-        return self.version.__le__(other.version)
-
     def __eq__(self, other: V):
         return self.version.__eq__(other.version)
 
-    def __ge__(self, other: V):
-        return self.version.__ge__(other.version)
-
-    def __gt__(self, other: V):
-        return self.version.__gt__(other.version)
-
-    def __ne__(self, other: V):
-        return self.version.__ne__(other.version)
-
 
 class Documentation(ABC):
     """
     Abstract class for all documentation updaters
     """
-    def __init__(self, path: str, **kwargs):
+    def __init__(self, path: str, build_jobs: int = 1, **kwargs):
         """
         Initialize Documentation updated object with empty list of version to update.
 
         :param path: Path to the documentation generator.
+        :param build_jobs: Number of versions built in parallel.
         :param kwargs: Parameters passed by child classes.
         """
 
         self.path = Path(path)
         """Path to the documentation generator"""
 
+        self.build_jobs = build_jobs
+        """Number of versions built in parallel"""
+
         self.versions: List[Version] = []
         """List of version which have to be updated"""
 
@@ -93,6 +112,16 @@ class Documentation(ABC):
         """
         pass
 
+    def build_version_unless_stopped(self, version: Version) -> Optional[Path]:
+        """
+        Generate documentation for selected version, unless the updater was interrupted.
+        :param version: Version to generate.
+        :return: Path to generated documentation.
+        """
+        if stop_event.is_set():
+            return None
+        return self.build_version(version)
+
     def update(self) -> List[Tuple[Version, Path]]:
         """
         Check for new available versions and generate documentation for new versions.
@@ -100,10 +129,11 @@ class Documentation(ABC):
         """
         updated: List[Tuple[Version, Path]] = []
         self.check_updates()
-        for version in self.versions:
-            path = self.build_version(version)
-            if path is not None:
-                updated.append((version, path))
+        with ThreadPoolExecutor(max_workers=max(1, self.build_jobs)) as executor:
+            paths = executor.map(self.build_version_unless_stopped, self.versions)
+            for version, path in zip(self.versions, paths):
+                if path is not None:
+                    updated.append((version, path))
 
         return updated
 
@@ -112,6 +142,10 @@ class ProcessedVersions:
     """
     Handle reading and writing processed versions.
     """
+
+    instances: ClassVar["weakref.WeakSet[ProcessedVersions]"] = weakref.WeakSet()
+    """All processed versions objects, pending versions are saved on exit"""
+
     def __init__(self, processed_versions_file: str, **kwargs):
         """
         Initializer for processed versions, which loads processed versions from the file on disk.
@@ -125,8 +159,20 @@ class ProcessedVersions:
         self.processed_versions: List[Version] = []
         """List of already versions"""
 
+        self.processed_versions_set: Set[Version] = set()
+        """Set of already processed versions, for fast lookups"""
+
+        self.processed_versions_changed = False
+        """Are there processed versions which were not saved to the file yet"""
+
+        self.processed_versions_lock = threading.RLock()
+        """Lock serializing saves, versions can be saved from a signal handler"""
+
         self.load_processed_versions()
 
+        # Save pending versions even if the update was interrupted.
+        ProcessedVersions.instances.add(self)
+
     def load_processed_versions(self):
         """
         Load processed versions from file on disk.
@@ -134,18 +180,77 @@ class ProcessedVersions:
         Versions are available in the `processed_versions` variable.
         """
         with open(self.processed_versions_file) as f:
-            config = yaml.load(f, Loader=yaml.BaseLoader)
+            config = yaml.load(f, Loader=YamlLoader)
             versions = config["versions"]
             self.processed_versions = [Version(v) for v in versions]
+            self.processed_versions_set = set(self.processed_versions)
+
+    def add_processed_version(self, version: Version):
+        """
+        Mark version as processed.
+
+        Change is kept in memory until `save_processed_versions` is called.
+
+        :param version: Processed version.
+        """
+        self.processed_versions.append(version)
+        self.processed_versions_set.add(version)
+        self.processed_versions_changed = True
 
     def save_processed_versions(self):
         """
-        Save processed version to file on disk.
+        Save processed version to file on disk, when there are new processed versions.
         """
-        with open(self.processed_versions_file, "w") as f:
-            versions = [v.name for v in sorted(self.processed_versions)]
+        with self.processed_versions_lock:
+            if not self.processed_versions_changed:
+                return
+
+            versions = [v.name for v in sorted(self.processed_versions, key=operator.attrgetter("version"))]
             config = {"versions": versions}
-            yaml.dump(config, f, default_flow_style=False)
+            data = yaml.dump(config, Dumper=YamlDumper, default_flow_style=False)
+            self.processed_versions_changed = False
+
+            # Don't rewrite the file when its content is the same
+            path = Path(self.processed_versions_file)
+            if path.exists() and path.read_text() == data:
+                return
+
+            path.write_text(data)
+
+
+def save_all_processed_versions():
+    """
+    Save pending processed versions of all updaters.
+    """
+    for processed_versions in list(ProcessedVersions.instances):
+        processed_versions.save_processed_versions()
+
+
+def terminate(signum, frame):
+    """
+    Signal handler, which saves pending processed versions and exits.
+
+    Exits with `os._exit`, raising `SystemExit` would wait for the running builds.
+    """
+    print(f"Terminated by signal {signum}, saving processed versions...")
+    save_all_processed_versions()
+    sys.stdout.flush()
+    os._exit(128 + signum)
+
+
+def interrupt(signum, frame):
+    """
+    Signal handler, which stops starting new builds.
+
+    Running builds get the same signal from the terminal and fail, versions which were already built are still returned
+    by `update`. The next interrupt raises `KeyboardInterrupt`.
+    """
+    print(f"Interrupted by signal {signum}, waiting for running builds...")
+    stop_event.set()
+    signal.signal(signum, signal.default_int_handler)
+
+
+atexit.register(save_all_processed_versions)
 
 
 class RepoUpdater(Documentation):
@@ -162,56 +267,173 @@ class RepoUpdater(Documentation):
     """
     Handle initializing repository.
     """
-    def __init__(self, repository_path: str, git_url: str, **kwargs):
+
+    fetch_tags: ClassVar[bool] = True
+    """Fetch tags from the remotes, updaters which don't use tags can skip them"""
+
+    def __init__(self, repository_path: str, git_url: str, depth: int = 0, **kwargs):
         """
         Handle initializing repository.
 
         :param repository_path: Path to cloned repository.
         :param git_url: URL to git repository.
+        :param depth: History depth of the clone and fetches, 0 means full history.
         """
         self.git_url = git_url
         """URL to git repository"""
 
-        self.repo: Repository = None
-        """Git repository"""
+        self.depth = depth
+        """History depth of the clone and fetches, 0 means full history"""
+
+        self._repo: Optional[Repository] = None
+        """Git repository, initialized on the first access"""
+
+        self._odb: Optional[pygit2.Odb] = None
+        """Object database of the git repository, initialized on the first access"""
+
+        self.repository_cloned = False
+        """Was repository cloned in this run"""
 
         super().__init__(**kwargs)
 
         self.repository_path = self.path.joinpath(repository_path)
         """Path to cloned repository"""
 
-    def initialize_repo(self):
+    @property
+    def repo(self) -> Repository:
+        """
+        Git repository, cloned or opened on the first access.
+        """
+        if self._repo is None:
+            self._repo = self.initialize_repo()
+        return self._repo
+
+    @property
+    def odb(self) -> pygit2.Odb:
+        """
+        Object database of the git repository, reused for all object reads.
+        """
+        if self._odb is None:
+            self._odb = self.repo.odb
+        return self._odb
+
+    def read_blob(self, oid: pygit2.Oid) -> bytes:
+        """
+        Read raw blob content directly from the object database.
+
+        :param oid: Blob id.
+        :return: Blob content.
+        """
+        _, data = self.odb.read(oid)
+        return data
+
+    def initialize_repo(self) -> Repository:
         """
         Initialize local repository.
 
-        Repository is available from `repo` veriable.
+        Use `repo` property to get the repository, it is initialized only once.
+        :return: Cloned or opened repository.
         """
         # Initialize new repository
         if not self.repository_path.exists():
             print(f"{self.name} clonning...")
             self.repository_path.mkdir(parents=True)
-            self.repo = clone_repository(self.git_url, str(self.repository_path), callbacks=self.Callbacks())
-            # self.repo.create_reference("refs/remotes/origin/HEAD", f"refs/remotes/origin/{self.repo.head.shorthand}")
+            repo = clone_repository(self.git_url, str(self.repository_path), callbacks=self.Callbacks(),
+                                    depth=self.depth)
+            self.repository_cloned = True
+            # repo.create_reference("refs/remotes/origin/HEAD", f"refs/remotes/origin/{repo.head.shorthand}")
+            return repo
         # Read repository
         else:
-            self.repo = Repository(str(self.repository_path))
+            return Repository(str(self.repository_path))
 
     def check_updates(self):
         """
         Initialize repository and check for new available versions.
         """
-        self.initialize_repo()
+        remotes = list(self.repo.remotes)
+
+        # Fresh clone already contains all branches and tags.
+        if self.repository_cloned:
+            return
 
         print(f"{self.name} fetching...")
-        for remote in self.repo.remotes:
-            remote.fetch(prune=GIT_FETCH_PRUNE, callbacks=self.Callbacks())
-            remote.fetch(prune=GIT_FETCH_PRUNE, callbacks=self.Callbacks(), refspecs=["refs/tags/*:refs/tags/*"])
+
+        # Remotes share tag references and FETCH_HEAD, fetch them one after another.
+        for remote in remotes:
+            self.fetch_remote(remote)
+
+    def fetch_remote(self, remote: pygit2.Remote):
+        """
+        Fetch branches and tags from the remote in a single fetch.
+
+        :param remote: Remote to fetch.
+        """
+        callbacks = self.Callbacks()
+
+        # Skip fetch when nothing has changed on the remote
+        if not self.remote_changed(remote, callbacks):
+            return
+
+        refspecs = remote.fetch_refspecs
+        if self.fetch_tags:
+            refspecs = refspecs + ["+refs/tags/*:refs/tags/*"]
+        remote.fetch(prune=GIT_FETCH_PRUNE, callbacks=callbacks, refspecs=refspecs, depth=self.depth)
+
+    def remote_changed(self, remote: pygit2.Remote, callbacks: pygit2.RemoteCallbacks) -> bool:
+        """
+        Compare branches and tags advertised by the remote with the local references, without fetching.
+
+        :param remote: Remote to check.
+        :param callbacks: Callbacks used to connect to the remote.
+        :return: True if remote has new, updated or deleted references.
+        """
+        fetch_refspecs = remote.fetch_refspecs
+        refspecs = [remote.get_refspec(i) for i in range(remote.refspec_count)]
+        refspecs = [r for r in refspecs if r.string in fetch_refspecs]
+
+        # Remote references mapped to the local names
+        remote_references = {}
+        for head in remote.ls_remotes(callbacks=callbacks):
+            name = head["name"]
+            if name.startswith(TAG_REFERENCE_PREFIX):
+                # Skip peeled annotated tags and tags which are not fetched
+                if self.fetch_tags and not name.endswith("^{}"):
+                    remote_references[name] = head["oid"]
+                continue
+            for refspec in refspecs:
+                if refspec.src_matches(name):
+                    remote_references[refspec.transform(name)] = head["oid"]
+                    break
+
+        # Local tags and remote tracking branches, without symbolic references like "origin/HEAD"
+        local_references = {}
+        for name in self.repo.references:
+            is_tag = name.startswith(TAG_REFERENCE_PREFIX)
+            if (is_tag and self.fetch_tags) or any(r.dst_matches(name) for r in refspecs):
+                target = self.repo.references[name].target
+                if isinstance(target, pygit2.Oid):
+                    local_references[name] = target
+
+        return remote_references != local_references
+
+    def tag_references(self) -> Iterator[str]:
+        """
+        Iterate over tag references without building the list of all references.
+
+        :return: Names of the tag references, e.g. "refs/tags/v1.0.0".
+        """
+        return (r.name for r in self.repo.references.iterator(ReferenceFilter.TAGS))
 
 
 class TagUpdater(RepoUpdater, ProcessedVersions):
     """
     Handle updating version from the repository tags.
     """
+
+    tag_prefix: ClassVar[str] = ""
+    """Prefix removed from the tag name to get the version name, e.g. `v`"""
+
     def __init__(self, minimum_version: str, stable_version: bool = False, **kwargs):
         """
         Handle updating version from the repository tags.
@@ -227,15 +449,6 @@ class TagUpdater(RepoUpdater, ProcessedVersions):
 
         super().__init__(**kwargs)
 
-    @classmethod
-    def normalize_tag(cls, tag: str) -> str:
-        """
-        Normalize version from tag.
-
-        It can for example remove "v" at the beginning of the name.
-        """
-        return tag
-
     def check_updates(self):
         """
         Check for new available versions from tags.
@@ -243,31 +456,43 @@ class TagUpdater(RepoUpdater, ProcessedVersions):
         super().check_updates()
 
         # Parse versions
-        tag_prefix = "refs/tags/"
-        regex = re.compile(f"^{tag_prefix}")
+        tag_prefix_length = len(TAG_REFERENCE_PREFIX)
+        prefix = self.tag_prefix
+        minimum_version = self.minimum_version
+        minimum_major = minimum_version.version.major
+        stable_version = self.stable_version
+        processed_versions = self.processed_versions_set
         versions: List[Version] = []
-        for tag in filter(lambda r: regex.match(r), self.repo.listall_references()):  # type: str
-            tag = tag.replace(tag_prefix, "")
+        for reference in self.tag_references():
+            tag = reference[tag_prefix_length:].removeprefix(prefix)
 
-            tag = self.__class__.normalize_tag(tag)
+            # Skip tags with older major version before parsing them
+            major = tag.partition(".")[0]
+            if major.isdecimal() and int(major) < minimum_major:
+                continue
+
+            # Skip tags which are not versions, e.g. "api/v1.0.0"
+            try:
+                version = Version(tag)
+            except InvalidVersion:
+                continue
 
-            version = Version(tag)
             # Only newer tags
-            if version < self.minimum_version:
+            if version < minimum_version:
                 continue
 
             # Process only stable versions
-            if self.stable_version and not version.is_stable:
+            if stable_version and not version.is_stable:
                 continue
 
             # Only not already processed versions:
-            if version in self.processed_versions:
+            if version in processed_versions:
                 continue
 
             versions.append(version)
 
         # Sort versions
-        self.versions = sorted(versions)
+        self.versions = sorted(versions, key=operator.attrgetter("version"))
 
 
 class BaseBuilder(Documentation, ProcessedVersions):
@@ -289,15 +514,30 @@ class BaseBuilder(Documentation, ProcessedVersions):
 
         super().__init__(**kwargs)
 
+        self.build_path = self.path / self.build_folder
+        """Path to the build folder"""
+
     @classmethod
-    def command(cls, version: Version) -> str:
+    def command(cls, version: Version) -> List[str]:
         """
         Prepares command which will be used to generate documentation.
 
         :param version: Version to generate.
-        :return: Command which will be used to generate documentation.
+        :return: Command arguments which will be used to generate documentation.
         """
-        return f"./build.sh {version.name}"
+        return ["./build.sh", version.name]
+
+    def update(self) -> List[Tuple[Version, Path]]:
+        """
+        Check for new available versions and generate documentation for new versions.
+
+        Processed versions are saved once, after all versions were built.
+        :return: List of generated versions and generated documentations
+        """
+        try:
+            return super().update()
+        finally:
+            self.save_processed_versions()
 
     def build_version(self, version: Version) -> Optional[Path]:
         """
@@ -307,34 +547,34 @@ class BaseBuilder(Documentation, ProcessedVersions):
         :return: Path to generated documentation.
         """
         print(f"{self.name} {version.name} processing...")
+        command = type(self).command(version)
         start_time = time.time()
-        process = subprocess.run(
-            self.__class__.command(version),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-            cwd=self.path)
+        output: Deque[str] = deque(maxlen=BUILD_OUTPUT_LINES)
+        with subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=self.path,
+                bufsize=1,
+                encoding="utf-8",
+                errors="replace") as process:
+            # Keep only the end of the output, build logs can be huge
+            for line in process.stdout:
+                output.append(line)
         stop_time = time.time()
         time_elapsed = stop_time - start_time
 
         # Success
         if process.returncode == 0:
             print(f"{self.name} {version.name} success {time_elapsed:0.3f}s...")
-            self.processed_versions.append(version)
-            self.save_processed_versions()
+            self.add_processed_version(version)
 
-            build_path = self.path. \
-                joinpath(self.build_folder). \
-                joinpath(version.name). \
-                joinpath(self.doc_name)
-            return build_path
+            return self.build_path / version.name / self.doc_name
         # Error
         else:
             print(f"{self.name} {version.name} failed...")
-            print("stdout:")
-            print(process.stdout)
-            print("stderr:")
-            print(process.stderr)
+            print("output:")
+            print("".join(output), end="")
         return None
 
 
@@ -1,3 +1,5 @@
+import shlex
+from typing import List
 from doc import TagDocumentation, Version
 
 
@@ -5,21 +7,18 @@ class Kubernetes(TagDocumentation):
     """
     Kubernetes updater.
     """
-    def __init__(self, path: str, repository_path: str, git_url: str, minimum_version: str):
+
+    tag_prefix = "v"
+
+    def __init__(self, path: str, repository_path: str, git_url: str, minimum_version: str, build_jobs: int = 1):
         super().__init__(path=path, repository_path=repository_path, git_url=git_url, minimum_version=minimum_version,
-                         stable_version=True, processed_versions_file="kubernetes.yml", doc_name="Kubernetes.tgz")
+                         stable_version=True, processed_versions_file="kubernetes.yml", doc_name="Kubernetes.tgz",
+                         build_jobs=build_jobs)
 
     @property
     def name(self):
         return "Kubernetes"
 
     @classmethod
-    def normalize_tag(cls, tag: str) -> str:
-        version_prefix = "v"
-        if tag.startswith(version_prefix):
-            tag = tag[len(version_prefix):]
-        return tag
-
-    @classmethod
-    def command(cls, version: Version):
-        return f"source env/bin/activate && ./build.sh {version.name}"
+    def command(cls, version: Version) -> List[str]:
+        return ["bash", "-c", f"source env/bin/activate && ./build.sh {shlex.quote(version.name)}"]
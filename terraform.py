@@ -1,15 +1,26 @@
 from doc import RepoUpdater, BaseBuilder, ProcessedVersions, Version
 import re
-from pygit2 import DiffFile, DiffDelta
+from pathlib import Path
+
+VERSION_REGEX = re.compile(r'h\.version\s*=\s*"(\S*)"')
+"""Regex matching Terraform version in the config.rb file"""
 
 
 class Terraform(RepoUpdater, BaseBuilder, ProcessedVersions):
     """
     Terraform updater.
     """
-    def __init__(self, path: str, repository_path: str, git_url: str):
-        super().__init__(path=path, repository_path=repository_path, git_url=git_url,
-                         processed_versions_file="terraform.yml", doc_name="Terraform.tgz")
+
+    # Version is read from config.rb, tags are not used.
+    fetch_tags = False
+
+    def __init__(self, path: str, repository_path: str, git_url: str, build_jobs: int = 1):
+        # Only the newest config.rb is used, history is not needed.
+        super().__init__(path=path, repository_path=repository_path, git_url=git_url, depth=1,
+                         processed_versions_file="terraform.yml", doc_name="Terraform.tgz", build_jobs=build_jobs)
+
+        self.head_file = Path(f"{self.processed_versions_file}.head")
+        """File with the last HEAD commit, which version was already processed"""
 
     @property
     def name(self):
@@ -19,28 +30,23 @@ class Terraform(RepoUpdater, BaseBuilder, ProcessedVersions):
         super().check_updates()
 
         config_file_path = "content/config.rb"
-        regex = re.compile(r"h.version\s*=\s*\"(\S*)\"")
 
         # Commit
         head = self.repo.revparse_single("remotes/origin/HEAD")
-        diff = head.tree.diff_to_tree()
-        diff_file: DiffFile
 
-        # Find config file path
-        for dd in diff.deltas:  # type: DiffDelta
-            df = dd.old_file
-            if df.path == config_file_path:
-                diff_file = df
-                break
+        # HEAD didn't change since the last processed version
+        if self.head_file.exists() and self.head_file.read_text().strip() == str(head.id):
+            return
 
         # Read config.rb file
-        blob = self.repo[diff_file.id]
-        data = blob.data.decode("utf-8")
-        version_str = regex.search(data).group(1)
+        entry = head.tree[config_file_path]
+        data = self.read_blob(entry.id).decode("utf-8")
+        version_str = VERSION_REGEX.search(data).group(1)
         version = Version(version_str)
 
         # Only not already processed versions:
-        if version in self.processed_versions:
+        if version in self.processed_versions_set:
+            self.head_file.write_text(str(head.id))
             return
 
         self.versions = [version]
@@ -3,21 +3,103 @@ import argparse
 import yaml
 import shutil
 import json
-from typing import List, Tuple
+import operator
+import os
+import pickle
+import signal
+import sys
+from typing import List, Tuple, TextIO
 from pathlib import Path
-from doc import Documentation, Version
+from concurrent.futures import ThreadPoolExecutor
+from doc import Documentation, Version, YamlLoader, interrupt, stop_event, terminate
 from kubernetes import Kubernetes
 from consul import Consul
 from packer import Packer
 from terraform import Terraform
 from vault import Vault
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 CONFIG_PATH = "config.yml"
+CONFIG_CACHE_PATH = CONFIG_PATH + ".cache.pkl"
 
 parser = argparse.ArgumentParser(description="Check for updates in the tracked dash repositories")
 args = parser.parse_args()
 
 
+def load_json(f: TextIO):
+    """
+    Load JSON file, using faster `orjson` parser when it is installed.
+
+    Files are still written with `json`, `orjson` can't indent with the 4 spaces used by the docset.json files.
+
+    :param f: Opened JSON file.
+    :return: Loaded JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+
+def fast_copy(src: Path, dst: Path):
+    """
+    Copy file content inside the kernel with `os.copy_file_range`, without user space buffers.
+
+    Falls back to `shutil.copyfile` when `os.copy_file_range` is not available and to copying through the already
+    opened files when it is not supported by the file system or stops before the end of the file.
+
+    :param src: Source file.
+    :param dst: Destination file.
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        # Size of the opened file, the source path is not stat-ed again.
+        remaining = os.fstat(f_src.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(f_src.fileno(), f_dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            pass
+
+        # Copy is not supported by the file system or it stopped early, copy the whole file again.
+        if remaining > 0:
+            f_src.seek(0)
+            f_dst.seek(0)
+            f_dst.truncate()
+            shutil.copyfileobj(f_src, f_dst)
+
+
+def link_or_copy(src: Path, dst: Path):
+    """
+    Hard link file to the destination, falls back to copy when the hard link can't be created.
+
+    Destination is replaced atomically, so the file previously linked to the destination is not modified.
+
+    :param src: Source file.
+    :param dst: Destination file.
+    """
+    # Destination is already linked to the source, renaming a link to the same file over it does nothing.
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+
+    tmp = dst.with_name(f"{dst.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        fast_copy(src, tmp)
+    os.replace(tmp, dst)
+
+
 class Dash:
     """
     Represents "Dash-User-Contributions" repository.
@@ -31,118 +113,93 @@ class Dash:
 
         self.path = Path(path)
 
-    def add_version(self, doc_name: str, version: Version, doc_path: Path):
+    def add_version(self, doc_set_path: Path, versions_dir_path: Path, version: Version, doc_path: Path) -> Path:
         """
-        Add new version to doc set.
+        Copy new version to doc set.
 
-        :param doc_name: Documentation name.
+        :param doc_set_path: Path to the doc set.
+        :param versions_dir_path: Path to the versions directory of the doc set.
         :param version: Version of the new documentation.
         :param doc_path: Path to generated documentation.
+        :return: Path to the copied documentation, relative to the doc set.
         """
-        doc_set_path = self.path.joinpath("docsets").joinpath(doc_name)
-        doc_set_json_path = doc_set_path.joinpath("docset.json")
-        versions_dir_path = doc_set_path.joinpath("versions")
         version_dir_path = versions_dir_path.joinpath(version.name)
         dst_doc_path = version_dir_path.joinpath(doc_path.name)
-        relative_dst_doc_path = dst_doc_path.relative_to(doc_set_path)
 
         # Create new version directory.
         version_dir_path.mkdir(parents=True, exist_ok=True)
 
         # Copy new doc to doc set.
-        shutil.copy(str(doc_path), str(version_dir_path))
-        print(f"{doc_name} added version: {version.name}")
-
-        # Update docset.json.
-        with open(doc_set_json_path, "r+") as f:
-            j = json.load(f)
+        fast_copy(doc_path, dst_doc_path)
+        print(f"{doc_set_path.name} added version: {version.name}")
 
-            specific_versions = j["specific_versions"]
-            specific_versions = self.append_version(specific_versions, version, relative_dst_doc_path)
-            j["specific_versions"] = specific_versions
-
-            # Save file
-            f.seek(0)
-            json.dump(j, f, indent=4)
+        return dst_doc_path.relative_to(doc_set_path)
 
     @staticmethod
-    def append_version(specific_versions: list, version: Version, path: Path) -> list:
+    def append_versions(specific_versions: list, versions: List[Tuple[Version, Path]]) -> list:
         """
-        Append specific_versions entry with new version and sort results in the docset.json file.
+        Append specific_versions entries with new versions and sort results in the docset.json file.
 
         :param specific_versions: Existing "specific_versions".
-        :param version: New version to add.
-        :param path: Path to the doc.
-        :return: Sorted "specific_versions" with added version.
+        :param versions: New versions to add and paths to the docs.
+        :return: Sorted "specific_versions" with added versions.
         """
-        # Check if version already exists.
-        exists = False
-        for v in specific_versions:  # type: dict
-            ver = v["version"]
-            if ver == version.name:
-                exists = True
-                break
-
-        # Stop is entry exists.
-        if exists:
-            return specific_versions
-
-        # Add new version.
-        ver = {"version": version.name, "archive": str(path)}
-        specific_versions.append(ver)
-
-        # Sort versions.
+        existing_versions = {v["version"] for v in specific_versions}
+        for version, path in versions:
+            # Skip existing entry.
+            if version.name in existing_versions:
+                continue
+
+            # Add new version.
+            ver = {"version": version.name, "archive": str(path)}
+            specific_versions.append(ver)
+            existing_versions.add(version.name)
+
+        # Sort versions, each version is parsed once and compared by the parsed version.
         def key(k: dict):
-            return Version(k["version"])
+            return Version(k["version"]).version
         specific_versions.sort(key=key, reverse=True)
 
         return specific_versions
 
-    def update_newest_version(self, doc_name: str, updated_versions: List[Tuple[Version, Path]]):
+    def update_newest_version(self, doc_set_path: Path, doc_set: dict, updated_versions: List[Tuple[Version, Path]]):
         """
         Updates newest and stable version of the documentation.
 
-        :param doc_name: Documentation name.
+        :param doc_set_path: Path to the doc set.
+        :param doc_set: Content of the docset.json file, updated in place.
         :param updated_versions: List of updated versions.
         """
-        doc_set_path = self.path.joinpath("docsets").joinpath(doc_name)
-        doc_set_json_path = doc_set_path.joinpath("docset.json")
+        specific_versions = doc_set["specific_versions"]
 
-        # Read docset.json to get newest stable version
-        with open(doc_set_json_path, "r+") as f:
-            j = json.load(f)
-            specific_versions = j["specific_versions"]
-
-            versions = [Version(v["version"]) for v in specific_versions]
-            stable_versions = [v for v in versions if v.is_stable]
-            stable_versions.sort()
+        versions = [Version(v["version"]) for v in specific_versions]
+        stable_versions = [v for v in versions if v.is_stable]
 
-            # Not stable versions -> Exit.
-            if len(stable_versions) == 0:
-                return
+        # Not stable versions -> Exit.
+        if len(stable_versions) == 0:
+            return
 
-            # Latest stable version.
-            latest_stable_version = stable_versions[-1]
+        # Latest stable version.
+        latest_stable_version = max(stable_versions, key=operator.attrgetter("version"))
 
-            # Find latest version in updates.
-            latest_stable_version_path = None
-            for version, path in updated_versions:
-                if version == latest_stable_version:
-                    latest_stable_version_path = path
-                    break
+        # Find latest version in updates.
+        latest_stable_version_path = None
+        for version, path in updated_versions:
+            if version == latest_stable_version:
+                latest_stable_version_path = path
+                break
 
-            # Latest version nas not found.
-            if latest_stable_version_path is None:
-                return
+        # Latest version nas not found.
+        if latest_stable_version_path is None:
+            return
 
-            # Copy latest documentation.
-            shutil.copy(str(latest_stable_version_path), str(doc_set_path))
-            print(f"{doc_name} added default version: {version.name}")
+        # Link latest documentation, it was already copied to the versions directory.
+        archive = next(v["archive"] for v in specific_versions if v["version"] == latest_stable_version.name)
+        link_or_copy(doc_set_path.joinpath(archive), doc_set_path.joinpath(latest_stable_version_path.name))
+        print(f"{doc_set_path.name} added default version: {latest_stable_version.name}")
 
-            # Update docset.json.
-            j["version"] = latest_stable_version.name
-            f.seek(0)
-            json.dump(j, f, indent=4)
+        # Update docset.json.
+        doc_set["version"] = latest_stable_version.name
 
     def add_versions(self, doc_name: str, versions: List[Tuple[Version, Path]]):
         """
@@ -151,19 +208,77 @@ class Dash:
         :param doc_name: Documentation name.
         :param versions: Versions to add.
         """
-        for v, p in versions:
-            self.add_version(doc_name, v, p)
+        if len(versions) == 0:
+            return
+
+        doc_set_path = Path(self.path, "docsets", doc_name)
+        doc_set_json_path = doc_set_path.joinpath("docset.json")
+        versions_dir_path = doc_set_path.joinpath("versions")
+
+        # Copy new docs, copying is I/O bound.
+        with ThreadPoolExecutor() as executor:
+            paths = list(executor.map(self.add_version,
+                                      [doc_set_path] * len(versions),
+                                      [versions_dir_path] * len(versions),
+                                      [v for v, _ in versions],
+                                      [p for _, p in versions]))
+
+        # Update docset.json once for all versions and the newest version.
+        with open(doc_set_json_path, "r+") as f:
+            j = load_json(f)
 
-        # Update newest version.
-        self.update_newest_version(doc_name=doc_name, updated_versions=versions)
+            specific_versions = j["specific_versions"]
+            specific_versions = self.append_versions(specific_versions, list(zip([v for v, _ in versions], paths)))
+            j["specific_versions"] = specific_versions
+
+            # Update newest version.
+            self.update_newest_version(doc_set_path=doc_set_path, doc_set=j, updated_versions=versions)
+
+            # Save file
+            f.seek(0)
+            json.dump(j, f, indent=4)
+            f.truncate()
 
 
 def load_config() -> dict:
+    """
+    Load configuration file.
+
+    Parsed configuration is pickled next to the configuration file, together with the file modification time and size.
+    It is reused only while both of them match the configuration file.
+    :return: Configuration.
+    """
+    config_stat = os.stat(CONFIG_PATH)
+
+    # Use cached configuration
+    try:
+        with open(CONFIG_CACHE_PATH, "rb") as f:
+            cache = pickle.load(f)
+        if cache["mtime_ns"] == config_stat.st_mtime_ns and cache["size"] == config_stat.st_size:
+            return cache["config"]
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+        pass
+
     with open(CONFIG_PATH, "r") as f:
-        return yaml.load(f, Loader=yaml.BaseLoader)
+        config = yaml.load(f, Loader=YamlLoader)
+
+    # Cache configuration
+    cache = {"mtime_ns": config_stat.st_mtime_ns, "size": config_stat.st_size, "config": config}
+    try:
+        with open(CONFIG_CACHE_PATH, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+    return config
 
 
 if __name__ == '__main__':
+    # Save already built versions when the updater is terminated.
+    signal.signal(signal.SIGTERM, terminate)
+    # Finish running builds and add built versions to Dash on Ctrl-C.
+    signal.signal(signal.SIGINT, interrupt)
+
     config = load_config()
 
     # Dash
@@ -180,7 +295,8 @@ if __name__ == '__main__':
         path=kubernetes_config["path"],
         repository_path=kubernetes_config["repository_path"],
         git_url=kubernetes_config["git_url"],
-        minimum_version=kubernetes_config["minimum_version"]
+        minimum_version=kubernetes_config["minimum_version"],
+        build_jobs=int(kubernetes_config.get("build_jobs", 1))
     )
     docs.append(kubernetes)
 
@@ -190,7 +306,8 @@ if __name__ == '__main__':
         path=consul_config["path"],
         repository_path=consul_config["repository_path"],
         git_url=consul_config["git_url"],
-        minimum_version=consul_config["minimum_version"]
+        minimum_version=consul_config["minimum_version"],
+        build_jobs=int(consul_config.get("build_jobs", 1))
     )
     docs.append(consul)
 
@@ -200,7 +317,8 @@ if __name__ == '__main__':
         path=packer_config["path"],
         repository_path=packer_config["repository_path"],
         git_url=packer_config["git_url"],
-        minimum_version=packer_config["minimum_version"]
+        minimum_version=packer_config["minimum_version"],
+        build_jobs=int(packer_config.get("build_jobs", 1))
     )
     docs.append(packer)
 
@@ -209,7 +327,8 @@ if __name__ == '__main__':
     terraform = Terraform(
         path=terraform_config["path"],
         repository_path=terraform_config["repository_path"],
-        git_url=terraform_config["git_url"]
+        git_url=terraform_config["git_url"],
+        build_jobs=int(terraform_config.get("build_jobs", 1))
     )
     docs.append(terraform)
 
@@ -219,15 +338,31 @@ if __name__ == '__main__':
         path=vault_config["path"],
         repository_path=vault_config["repository_path"],
         git_url=vault_config["git_url"],
-        minimum_version=vault_config["minimum_version"]
+        minimum_version=vault_config["minimum_version"],
+        build_jobs=int(vault_config.get("build_jobs", 1))
     )
     docs.append(vault)
 
     # Start processing.
-    for doc in docs:
+    with ThreadPoolExecutor(max_workers=len(docs)) as executor:
+
+        # Update documentations in parallel.
+        futures = [executor.submit(doc.update) for doc in docs]
+
+        # Add new versions, Dash repository is modified only from the main thread.
+        errors: List[Exception] = []
+        for doc, future in zip(docs, futures):
+            try:
+                updates = future.result()
+            except Exception as e:
+                print(f"{doc.name} failed: {e}")
+                errors.append(e)
+                continue
+
+            dash.add_versions(doc_name=doc.name, versions=updates)
 
-        # Update documentation.
-        updates = doc.update()
+    if errors:
+        raise errors[0]
 
-        # Add new versions.
-        dash.add_versions(doc_name=doc.name, versions=updates)
+    if stop_event.is_set():
+        sys.exit(128 + signal.SIGINT)